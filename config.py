@@ -0,0 +1,19 @@
+# --- CONFIGURATION ---
+# Settings shared by the SHSF Pi Hub (shsf-hub.py)
+HM10_NODE = 7          # Position in devices.txt
+CHAR_HANDLE = 0        # HM-10 Serial Write Handle
+MQTT_BROKER = "localhost"
+TOPIC_WILDCARD = "shsf/+/commands" # Use a wildcard '+' so we hear from everyone
+TOPIC_HEARTBEAT = "shsf/heartbeat"
+TOPIC_RSSI = "shsf/giebel_throttle/rssi"
+GUI_SENDER = "hub"
+BLE_BATCH_SIZE = 16    # Max commands sent per BLE worker wakeup
+BLE_RESPONSE_MS = 100  # Read_notify window for replies to written commands
+BLE_READ_HOT_MS = 10   # Read_notify window on each BLE worker pass
+BLE_READ_IDLE_MS = 200 # Max wait for a new command when none was sent recently
+BLE_HOT_WINDOW = 0.5   # Seconds after a write to poll BLE without idle waits
+COMMAND_QUEUE_SIZE = 256 # Oldest commands are dropped beyond this
+LOG_MAX_LINES = 500    # Log window is trimmed once it exceeds this many lines
+LOG_KEEP_LINES = 400   # Lines kept after the log window is trimmed
+MQTT_RECONNECT_MIN_DELAY = 1  # Seconds before the first MQTT reconnect attempt
+MQTT_RECONNECT_MAX_DELAY = 60 # Reconnect delay doubles up to this many seconds
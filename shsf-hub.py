@@ -5,53 +5,80 @@ import queue
 import paho.mqtt.client as mqtt
 from guizero import App, PushButton, Text, Box, TextBox
 import signal
+import socket
 import sys
 import time
-from datetime import datetime
-
-# --- CONFIGURATION ---
-HM10_NODE = 7          # Position in devices.txt
-CHAR_HANDLE = 0        # HM-10 Serial Write Handle
-MQTT_BROKER = "localhost"
-TOPIC_WILDCARD = "shsf/+/commands" # Use a wildcard '+' so we hear from everyone
-TOPIC_HEARTBEAT = "shsf/heartbeat"
-TOPIC_RSSI = "shsf/giebel_throttle/rssi"
-GUI_SENDER = "hub"
-mqtt_sender = "Unknown"
-
-command_queue = queue.Queue()
+from collections import deque
+from functools import partial
+
+from config import (HM10_NODE, CHAR_HANDLE, MQTT_BROKER, TOPIC_WILDCARD,
+                    TOPIC_HEARTBEAT, TOPIC_RSSI, GUI_SENDER, BLE_BATCH_SIZE,
+                    BLE_RESPONSE_MS, BLE_READ_HOT_MS, BLE_READ_IDLE_MS,
+                    BLE_HOT_WINDOW, COMMAND_QUEUE_SIZE, LOG_MAX_LINES,
+                    LOG_KEEP_LINES, MQTT_RECONNECT_MIN_DELAY,
+                    MQTT_RECONNECT_MAX_DELAY)
+
+command_queue = queue.SimpleQueue()  # Holds (sender, payload) tuples
+current_sender = [("Unknown", "shsf/Unknown/responses")]  # (sender, response topic) of the last command written to BLE
+_response_topics = {}          # Cached response topic per sender
+cmd_event = threading.Event()  # Wakes ble_worker when a command is queued
 running = True
 hm10_name = "Unknown Device"
+_log_buf = deque(maxlen=1000)  # Log entries waiting for the next GUI flush
+_log_lock = threading.Lock()
+_log_lines = deque(maxlen=LOG_MAX_LINES)  # Lines currently shown in the log window
+_line_count = 0
+_ui_pending = {}               # GUI updates waiting for the next flush: fn -> args
+_ui_lock = threading.Lock()
+
+# --- RSSI LOOKUP TABLE ---
+def _build_rssi_table():
+    """Maps dBm -> (quality %, color) for every signed-byte RSSI value."""
+    table = {}
+    for dbm in range(-128, 128):
+        # Convert dBm to Percentage (-100 to -50 scale)
+        # -50 or better = 100%, -100 or worse = 0%
+        quality = max(0, min(100, 2 * (dbm + 100))) # Keep between 0-100
+        color = "green" if quality > 75 else "orange" if quality > 40 else "red"
+        table[dbm] = (quality, color)
+    return table
+
+RSSI_TABLE = _build_rssi_table()
+
+# --- BLE DATA HELPER ---
+def _to_str(data):
+    """Converts BLE data (byte list, bytes or str) to a stripped string."""
+    if isinstance(data, list):
+        data = bytes(data)
+    if isinstance(data, (bytes, bytearray)):
+        # latin-1 maps each byte to the same character as chr(b)
+        return data.decode("latin-1").strip()
+    return str(data).strip()
 
 # --- BLE CALLBACK (Nano -> Pi) ---
 def ble_callback(HM10_NODE, CHAR_HANDLE, data, datalen):
     # 'data' arrives as a list of bytes
-    message = "".join(chr(b) for b in data).strip()
-    print(f"[BLE] Received: {message}")
-    add_to_log(f"[BLE] Received: {message}")
+    message = _to_str(data)
+    log(f"[BLE] Received: {message}")
 
     # Manage the response
-    if mqtt_sender != GUI_SENDER:
-        # Forward to sender via MQTT
-        topic = f"shsf/{mqtt_sender}/responses"
-        mqtt_client.publish(topic, message)
+    sender, topic = current_sender[0]
+    if sender != GUI_SENDER:
+        # Forward to sender via MQTT (encoded here, as paho would for a str)
+        mqtt_client.publish(topic, message.encode("utf-8"))
 
 # --- BLE WORKER THREAD ---
 def ble_worker():
     global running
     global hm10_name
-    print("[BLE] Initializing ...")
-    add_to_log("[BLE] Initializing ...")
+    log("[BLE] Initializing ...")
     if btfpy.Init_blue("devices.txt") != 1:
-        print("[BLE] Failed to initialize.")
-        add_to_log("[BLE] Failed to initialize.")
+        log("[BLE] Failed to initialize.")
         return
 
-    print(f"[BLE] Connecting to HM-10 (Node {HM10_NODE})...")
-    add_to_log(f"[BLE] Connecting to HM-10 (Node {HM10_NODE})...")
+    log(f"[BLE] Connecting to HM-10 (Node {HM10_NODE})...")
     if (btfpy.Connect_node(HM10_NODE,btfpy.CHANNEL_LE,0) == 0):
-        print("[BLE] Failed to connect.")
-        add_to_log("[BLE] Failed to connect.")
+        log("[BLE] Failed to connect.")
         return
         
     if(btfpy.Ctic_ok(HM10_NODE,CHAR_HANDLE) == 1):
@@ -59,39 +86,69 @@ def ble_worker():
         raw_name = btfpy.Device_name(HM10_NODE)
         
         # 2. Convert to string (handling potential byte-list format)
-        if isinstance(raw_name, list):
-            hm10_name = "".join(chr(b) for b in raw_name).strip()
-        else:
-            hm10_name = str(raw_name).strip()
+        hm10_name = _to_str(raw_name)
 
         # 3. Update the GUI label directly
         update_status(f"{hm10_name} Status: Connected", "green")
 
         # Register callback and enable notifications
-        print(f"[BLE] Connected to LE server: {hm10_name}")
-        add_to_log(f"[BLE] Connected to LE server: {hm10_name}")
+        log(f"[BLE] Connected to LE server: {hm10_name}")
         btfpy.Notify_ctic(HM10_NODE,CHAR_HANDLE,btfpy.NOTIFY_ENABLE,ble_callback)
         
+        hot_until = 0.0  # Replies may still arrive until this time
         while running:
-            try:
-                # Get command from GUI or MQTT
-                cmd = command_queue.get(timeout=0.1)
-                print(f"[BLE] Sending: {cmd}")
-                add_to_log(f"[BLE] Sending: {cmd}")
+            # Drain a batch of commands queued by the GUI or MQTT
+            batch = []
+            while len(batch) < BLE_BATCH_SIZE:
+                try:
+                    batch.append(command_queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            # Write the batch back-to-back (one command per HM-10 frame)
+            for sender, cmd in batch:
+                # Route the response back to this sender
+                if sender != current_sender[0][0]:
+                    # ble_callback only runs inside Read_notify, so collect any
+                    # replies still due to the previous sender before switching
+                    if time.monotonic() < hot_until:
+                        btfpy.Read_notify(BLE_RESPONSE_MS)
+                    topic = _response_topics.get(sender)
+                    if topic is None:
+                        topic = _response_topics.setdefault(sender, f"shsf/{sender}/responses")
+                    current_sender[0] = (sender, topic)
+                log(f"[BLE] Sending: {cmd}")
                 btfpy.Write_ctic(HM10_NODE,CHAR_HANDLE,cmd + "\r",0)
-                btfpy.Read_notify(100)
-                command_queue.task_done()
-            except queue.Empty:
-                # Essential: allows btfpy to process incoming data packets
-                btfpy.Sleep_ms(50) 
+                hot_until = time.monotonic() + BLE_HOT_WINDOW
+
+            # Essential: allows btfpy to process incoming data packets
+            # (kept short because Read_notify blocks and can't be woken)
+            btfpy.Read_notify(BLE_READ_HOT_MS)
+
+            # When idle, sleep until the next command arrives (or poll BLE again)
+            if time.monotonic() >= hot_until:
+                cmd_event.wait(timeout=BLE_READ_IDLE_MS / 1000)
+            cmd_event.clear()
     else:
-        print("[BLE] Data characteristic FFE1 not found.")
-        add_to_log("[BLE] Data characteristic FFE1 not found.")
+        log("[BLE] Data characteristic FFE1 not found.")
+
+# --- TIMESTAMP HELPER ---
+_ts_cache = [(0, "")]  # (epoch second, formatted HH:MM:SS)
+
+def _ts():
+    """Returns the local time as HH:MM:SS, formatted at most once per second."""
+    now = int(time.time())
+    second, text = _ts_cache[0]
+    if now != second:
+        t = time.localtime(now)
+        text = f"{t.tm_hour:02d}:{t.tm_min:02d}:{t.tm_sec:02d}"
+        _ts_cache[0] = (now, text)
+    return text
 
 # --- HEARTBEAT ---
 def send_heartbeat():
     # Using app.display(), so using guizero's internal timer with app.repeat()
-    timestamp = datetime.now().strftime("%H:%M:%S")
+    timestamp = _ts()
     
     # Publish a simple timestamp to let everyone know we are alive
     mqtt_client.publish(TOPIC_HEARTBEAT, timestamp)
@@ -102,58 +159,106 @@ def process_command(payload, sender):
 
     add_to_log(f"[MQTT] Command '{payload}' from {sender}")
     
-    # Update global variable mqtt_sender for ble_callback
-    global mqtt_sender
-    mqtt_sender = sender
-    
     # Update the GUI label to show identity
     update_status(f"Last Cmd: {payload} (from {sender})", "blue")
 
     # Send to the BLE queue for the Nano
-    command_queue.put(payload)
+    _enqueue((sender, payload))
+
+def _enqueue(entry):
+    """Queues a (sender, payload) entry for BLE and wakes the BLE worker."""
+    if command_queue.qsize() >= COMMAND_QUEUE_SIZE:
+        # BLE link is stalled, so drop the oldest command to make room
+        try:
+            command_queue.get_nowait()
+            add_to_log("[QUEUE] Dropped oldest command")
+        except queue.Empty:
+            pass
+    command_queue.put(entry)
+    cmd_event.set()
+
+# --- GUI BUTTON COMMANDS ---
+# Queue entries, log lines and status text for the fixed GUI buttons are
+# built once here instead of on every click
+_BTN_HORN_ENTRY = (GUI_SENDER, "h")
+_BTN_BLOCKS_ON_ENTRY = (GUI_SENDER, "ba o")
+_PRELOG_HORN = f"[MQTT] Command 'h' from {GUI_SENDER}"
+_PRELOG_BLOCKS_ON = f"[MQTT] Command 'ba o' from {GUI_SENDER}"
+_STATUS_HORN = f"Last Cmd: h (from {GUI_SENDER})"
+_STATUS_BLOCKS_ON = f"Last Cmd: ba o (from {GUI_SENDER})"
+
+def _fast_push(entry, prelog, status):
+    """Queues a prebuilt GUI command (runs on the Tk main thread)."""
+    add_to_log(prelog)
+    _set_status(status, "blue")
+    _enqueue(entry)
 
 # --- MQTT SETUP ---
-def on_message(client, userdata, message):
-    topic = message.topic  # e.g., "home/r4/commands"
+def _on_rssi(client, userdata, message):
+    """Updates the WiFi health label from the throttle's RSSI topic."""
+    try:
+        # Look up quality and health color for this dBm reading
+        # (clamped to the table range, which already covers 0% and 100%)
+        quality, color = RSSI_TABLE[max(-128, min(127, int(message.payload)))]
+
+        _ui(_set_health, quality, color)
+
+        # Log RSSI if the signal gets too low
+        if quality <= 75: add_to_log("[WIFI] Giebel Throttle signal is weak!")
+    except:
+        pass
+
+def _on_command(client, userdata, message):
+    """Routes a command from any 'shsf/<sender>/commands' topic."""
     payload = message.payload.decode("utf-8")
 
-    if topic == TOPIC_RSSI:
-        try:
-            dbm = int(payload)
-            # Convert dBm to Percentage (-100 to -50 scale)
-            # -50 or better = 100%, -100 or worse = 0%
-            quality = 2 * (dbm + 100)
-            quality = max(0, min(100, quality)) # Keep between 0-100
-            
-            health_label.value = f"Giebel Throttle WiFi Signal: {quality}%"
-            
-            # Change color based on health
-            if quality > 75: health_label.text_color = "green"
-            elif quality > 40: health_label.text_color = "orange"
-            else: health_label.text_color = "red"
-
-            # Log RSSI if the signal gets too low
-            if quality <= 75: add_to_log("[WIFI] Giebel Throttle signal is weak!")
-        except:
-            pass
-    else:
-        # Identify the sender by splitting the topic string
-        # topic.split('/') results in ['home', 'sender', 'commands']
-        parts = topic.split('/')
-        sender = parts[1] if len(parts) > 1 else "unknown"
+    # Identify the sender from the middle segment of the topic
+    # e.g. 'shsf/sender/commands' -> 'sender'
+    _, _, rest = message.topic.partition('/')
+    sender, _, _ = rest.partition('/')
+    sender = sender or "unknown"
+
+    # Route to the processor
+    process_command(payload, sender)
+
+def on_connect(client, userdata, flags, rc):
+    """Runs on every (re)connect: tunes the socket and restores subscriptions."""
+    if rc != 0:
+        add_to_log(f"[MQTT] Connect failed rc={rc}")
+        return
+
+    # Disable Nagle so small command/response packets go out immediately
+    client.socket().setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    # Subscriptions are lost with a clean session, so renew them here
+    client.subscribe(TOPIC_WILDCARD)
+    add_to_log(f"[MQTT] Subscribed to: {TOPIC_WILDCARD}")
+
+    client.subscribe(TOPIC_RSSI)
+    add_to_log(f"[MQTT] Subscribed to: {TOPIC_RSSI}")
 
-        # Route to the processor
-        process_command(payload, sender)    
+def on_disconnect(client, userdata, rc):
+    """Logs broker disconnects; paho's loop thread reconnects with backoff."""
+    if rc != 0:
+        add_to_log(f"[MQTT] Disconnected rc={rc}, reconnecting...")
 
 mqtt_client = mqtt.Client()
-mqtt_client.on_message = on_message
+mqtt_client.on_connect = on_connect
+mqtt_client.on_disconnect = on_disconnect
+# Exponential reconnect backoff so a down broker can't cause a retry storm
+mqtt_client.reconnect_delay_set(min_delay=MQTT_RECONNECT_MIN_DELAY, max_delay=MQTT_RECONNECT_MAX_DELAY)
+# Bound paho's internal outgoing queues
+mqtt_client.max_inflight_messages_set(20)
+mqtt_client.max_queued_messages_set(1000)
+# Let paho dispatch by topic instead of routing in a single on_message
+mqtt_client.message_callback_add(TOPIC_RSSI, _on_rssi)
+mqtt_client.message_callback_add(TOPIC_WILDCARD, _on_command)
 
 # --- EXIT FUNCTION ---
 def shutdown_system():
     """Cleans up all processes and exits the script."""
     global running
-    print("\n[!] Shutting down system...")
-    add_to_log("\n[!] Shutting down system...")
+    log("\n[!] Shutting down system...", always=True)
     running = False              # Stops the BLE thread loop
     mqtt_client.loop_stop()      # Stops the MQTT background thread
     app.destroy()                # Closes the GUI window
@@ -162,8 +267,7 @@ def shutdown_system():
 # --- SHUTDOWN FUNCTION ---
 def pi_shutdown():
     if app.yesno("Shutdown", "Are you sure you want to shut down the Pi?"):
-        print("\n[!] Shutting down Pi...")
-        add_to_log("\n[!] Shutting down Pi...")
+        log("\n[!] Shutting down Pi...", always=True)
         # Clean up before hardware off
         global running
         running = False
@@ -178,27 +282,105 @@ def signal_handler(signum, frame):
 signal.signal(signal.SIGINT, signal_handler)
 
 # --- LOG HELPER FUNCTION ---
+_TTY = sys.stdout.isatty()  # Only echo to stdout when a console is attached
+
+def log(message, always=False):
+    """Logs a message to the GUI log window (and the console, if any).
+
+    With always=True the message also goes to stderr even without a
+    console, for errors and shutdown notices the GUI may never display.
+    """
+    if always:
+        print(message, file=sys.stderr)
+    elif _TTY:
+        print(message)
+    add_to_log(message)
+
 def add_to_log(message):
     """Adds a timestamped message to the GUI log window."""
-    timestamp = datetime.now().strftime("%H:%M:%S")
+    timestamp = _ts()
     new_entry = f"[{timestamp}] {message}"
     
-    # Prepend the new text at the top (or append to bottom)
-    # We'll append to the bottom for a traditional log feel
-    log_window.append(new_entry)
-    
-    # Auto-scroll to the bottom
-    # (In guizero/tkinter, this happens automatically when appending)
+    # Buffer the entry; _flush_log writes it to the window on the GUI timer
+    with _log_lock:
+        _log_buf.append(new_entry)
+
+def _flush_log():
+    """Writes all buffered log entries to the GUI in a single update."""
+    global _line_count
+    with _log_lock:
+        if not _log_buf:
+            return
+        entries = list(_log_buf)
+        _log_buf.clear()
+
+    _log_lines.extend(entries)
+    _line_count += len(entries)
+
+    if _line_count > LOG_MAX_LINES:
+        # Log is full: rewrite it once with only the newest lines
+        kept = list(_log_lines)[-LOG_KEEP_LINES:]
+        log_window.value = "\n".join(kept)
+        _line_count = len(kept)
+        log_window.tk.see("end")
+    else:
+        # We'll append to the bottom for a traditional log feel
+        log_window.append("\n".join(entries))
+        # Auto-scroll to the bottom
+        # (In guizero/tkinter, this happens automatically when appending)
 
 # --- CLEAR LOG FUNCTION ---
 def clear_log():
+    global _line_count
     log_window.clear()
+    _log_lines.clear()
+    _line_count = 0
     add_to_log("Log cleared.")
 
+# --- GUI THREAD HELPER ---
+def _ui(fn, *args):
+    """Queues fn(*args) for the Tk main thread (Tk is not thread-safe).
+
+    Only the latest call per function is kept; _flush_ui applies it.
+    """
+    with _ui_lock:
+        _ui_pending[fn] = args
+
+def _flush_ui():
+    """Applies queued GUI updates (runs on the Tk timer)."""
+    with _ui_lock:
+        if not _ui_pending:
+            return
+        pending = list(_ui_pending.items())
+        _ui_pending.clear()
+
+    for fn, args in pending:
+        fn(*args)
+
 # --- UPDATE STATUS INDICATOR ---
 def update_status(message, color):
-    status_label.value = message
-    status_label.text_color = color
+    _ui(_set_status, message, color)
+
+def _set_status(message, color):
+    _set(status_label, "value", message)
+    _set(status_label, "text_color", color)
+
+# --- UPDATE WIFI HEALTH INDICATOR ---
+def _set_health(quality, color):
+    _set(health_label, "value", f"Giebel Throttle WiFi Signal: {quality}%")
+    _set(health_label, "text_color", color)
+
+# --- CACHED WIDGET SETTER ---
+_widget_cache = {}  # (widget id, attribute) -> last value written
+
+def _set(widget, attr, val):
+    """Sets a widget attribute, skipping the Tk update if it is unchanged."""
+    key = (id(widget), attr)
+    old = _widget_cache.get(key)
+    if old is val or old == val:
+        return
+    _widget_cache[key] = val
+    setattr(widget, attr, val)
 
 # --- GUI ---
 app = App(title="SHSF - Pi Hub", width=500, height=600)
@@ -220,8 +402,8 @@ Text(app, "")
 
 # Container for control buttons
 button_box = Box(app, layout="grid")
-PushButton(button_box, text="Horn", grid=[0,0], command=lambda: process_command("h", GUI_SENDER))
-PushButton(button_box, text="All Blocks ON", grid=[1,0], command=lambda: process_command("ba o", GUI_SENDER))
+PushButton(button_box, text="Horn", grid=[0,0], command=partial(_fast_push, _BTN_HORN_ENTRY, _PRELOG_HORN, _STATUS_HORN))
+PushButton(button_box, text="All Blocks ON", grid=[1,0], command=partial(_fast_push, _BTN_BLOCKS_ON_ENTRY, _PRELOG_BLOCKS_ON, _STATUS_BLOCKS_ON))
 
 # Spacer
 Text(app, "")
@@ -258,24 +440,20 @@ try:
     mqtt_client.connect(MQTT_BROKER, 1883)
     # update_status("[MQTT] Connected to Broker!", "green")
 
-    mqtt_client.subscribe(TOPIC_WILDCARD)
-    add_to_log(f"[MQTT] Subscribed to: {TOPIC_WILDCARD}")
-
-    mqtt_client.subscribe(TOPIC_RSSI)
-    add_to_log(f"[MQTT] Subscribed to: {TOPIC_RSSI}")
-
+    # Subscriptions are made in on_connect once the loop thread is running
     mqtt_client.loop_start()
 
     ble_thread = threading.Thread(target=ble_worker, daemon=True)
     ble_thread.start()
     
     app.repeat(10000, send_heartbeat) # Runs send_heartbeat every 10,000ms
+    app.repeat(100, _flush_log)       # Flushes buffered log lines every 100ms
+    app.repeat(100, _flush_ui)        # Applies queued label updates every 100ms
     app.display() # This blocks until shutdown_system() calls app.destroy()
     
     print("Script finished safely.")
     sys.exit(0)
 
 except Exception as e:
-    print(f"\n[!] Main Loop Error: {e}")
-    add_to_log(f"\n[!] Main Loop Error: {e}")
+    log(f"\n[!] Main Loop Error: {e}", always=True)
     shutdown_system()